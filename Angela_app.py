@@ -1,326 +1,205 @@
 import streamlit as st
-import pandas as pd
-import pdfplumber
-import re  # Para usar Expresiones Regulares (Regex)
 from datetime import datetime  # Para formatear la fecha
-import locale  # Para forzar el idioma español en la fecha
 import io
-import xlsxwriter
-# Nueva librería para leer archivos Word (.docx)
-import docx
-
-# ⚠️ CONFIGURACIÓN GLOBAL (Mapeo de meses y Locale)
-# Se mantiene fuera de la clase ya que son constantes de configuración
-MONTH_MAPPING = {
-    'enero': 'January', 'febrero': 'February', 'marzo': 'March',
-    'abril': 'April', 'mayo': 'May', 'junio': 'June',
-    'julio': 'July', 'agosto': 'August', 'septiembre': 'September',
-    'octubre': 'October', 'noviembre': 'November', 'diciembre': 'December'
-}
-
-# Reglas de Extracción Centralizadas (para PDF y DOCX)
-EXTRACTION_RULES = {
-    "CLIENT": [
-        # Regla 1 (MÁXIMA PRECISIÓN para Razón Social):
-        r"(?:SEÑOR\s*\(?ES\)?\s*:\s*)([^\n\r]+?)(?=\s*(?:R\.?U\.?T\.|GIRO|DIRECCI[ÓO]N|FECHA|COMUNA|[\n\r]|$))",
-        # Regla 2 (Fallback si no hay R.U.T. cerca): Busca SR(A): NOMBRE...
-        r"(?:SR\.\(?A\)?[\s:]*)([^\n\r]+?)(?:\s+RUT|[\n\r]|$)",
-        # Regla 3 (Flexible): Fallback por si no tiene prefijo formal
-        r"(?:SR\.\(?A\)?|Hola|Estimado\s*:\s*)?([^\n\r]+?)(?:\s+RUT|[\n\r]|$)"
-    ],
-    "NUMBER": [r"N[°º]\s*:\s*(\d+)", r"N[°º]\s*(\d+)", r"N°\s*:\s*(\d+)"],
-    "DATE": [
-        {"regex": r"Fecha\s+(?:de\s+)?Emisi[óo]n\s*:\s*(\d{1,2})\s+de\s+(\w+)\s+(?:del|de)\s+(\d{4})",
-         "format": "LONG_FORMAT"},
-        {"regex": r"Fecha\s*:\s*(\d{1,2})[\s\-\/](\d{1,2})[\s\-\/](\d{2,4})",
-         "format": "DD_MM_YY"}
-    ],
-    "TOTAL": [r"TOTAL\s+\$\s*([\d\.,]+)", r"Total\s+Cuenta\s+Única\s+Telefónica\s+\$\s*([\d\.,]+)"],
-    "DESCRIPTION": [r"(BOLETA\s+ELECTRONICA)", r"(GUIA\s+DE\s+DESPACHO\s+ELECTRONICA)", r"([A-Z0-9]{2,}[-][A-Z0-9]{2,})", r"\b([A-Z]{3,}\d{2,})\b", r"(SII[^\n\r]+SANTIAGO)"]
-}
-
-# Se intenta configurar el locale.
-try:
-    locale.setlocale(locale.LC_TIME, 'es_ES.UTF-8')
-except locale.Error:
+import os
+import hashlib
+import gc
+import atexit
+import multiprocessing
+import threading
+import csv
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+# ⚠️ pypdfium2, python-docx y xlsxwriter se importan dentro de las funciones que los
+# usan: la primera carga de la página no paga su importación (~110 ms en total)
+# hasta que el usuario pulsa "Procesar".
+import extraccion
+from extraccion import EMPTY_QUOTATION, extract_docx, extract_pdf
+
+# Desde cuántos archivos (PDF o DOCX) conviene repartir la extracción entre procesos.
+# Con PDFium cada factura toma ~1 ms por página y un DOCX ~7 ms; con menos archivos
+# manda el costo de crear procesos.
+PARALLEL_MIN_FILES = 8
+# Cada cuántos archivos extraídos en serie se fuerza una recolección de basura: el proceso
+# de Streamlit vive mucho tiempo y así la memoria no crece a lo largo de un lote grande.
+GC_EVERY_FILES = 32
+# Filas que se muestran en la vista previa de la tabla consolidada
+PREVIEW_MAX_ROWS = 50
+# Máximo de resultados guardados en el caché por contenido (por tipo de archivo)
+RESULTS_CACHE_MAX_ENTRIES = 1000
+
+
+def _docx_available():
+    """ Indica si python-docx está instalado; si no, lo avisa en la app. """
     try:
-        locale.setlocale(locale.LC_TIME, 'Spanish_Spain.1252')
-    except locale.Error:
-        pass
+        import docx  # noqa: F401
+    except ImportError:
+        st.error("Error: La librería 'python-docx' (import docx) no está instalada. Es necesaria para procesar archivos Word.")
+        return False
+    return True
 
 
 # ===============================================
-# FUNCIONES AUXILIARES DE EXTRACCIÓN Y LIMPIEZA
+# INTERFAZ STREAMLIT (Lógica de la Aplicación Web)
 # ===============================================
 
-def _find_client_in_text(text, rules):
-    """ Busca el nombre del cliente usando las reglas de FacturaExtractor. """
-    patterns = rules.get("CLIENT", [])
-    for pattern in patterns:
-        search_flags = re.IGNORECASE
-        match = re.search(pattern, text, search_flags)
-        if match:
-            result = match.group(1).strip() if len(match.groups()) > 0 else ""
-            # --- LIMPIEZA CRÍTICA ---
-            result = re.sub(
-                r"^(SEÑOR\s*\(?ES\)?\s*:\s*|SR\.\(?A\)?[\s:]*)", "", result, flags=re.IGNORECASE).strip()
-            result = re.sub(r"\s*R\.?U\.?T\..*$", "",
-                            result, flags=re.IGNORECASE).strip()
-            result = result.replace(':', '').strip()
-            return result
-    return "No encontrado"
-
-
-# ===============================================
-# CLASE DE EXTRACCIÓN PDF
-# ===============================================
 
-class FacturaExtractor:
-    """ Encapsula la lógica y las reglas de extracción para un tipo de documento PDF. """
-
-    def __init__(self, pdf_file):
-        """Inicializa el extractor leyendo y limpiando el texto del PDF."""
-
-        # 🎯 Almacenamos el objeto pdfplumber y el texto completo (limpiado de espacios)
-        # y el texto de la primera página (para la extracción de códigos específicos)
-        try:
-            with pdfplumber.open(pdf_file) as pdf:
-                # Texto Completo (para campos generales como total, fecha, etc.)
-                text = "".join(page.extract_text() for page in pdf.pages)
-                text = text.replace('\n', ' ').replace('\r', ' ')
-                self.text = re.sub(r'\s+', ' ', text).strip()
-
-                # Texto de la Primera Página (para los códigos específicos)
-                if len(pdf.pages) > 0:
-                    self.page_1_text = pdf.pages[0].extract_text()
-                else:
-                    self.page_1_text = ""
-
-        except Exception as e:
-            self.text = ""
-            self.page_1_text = ""
-            st.warning(f"Error al cargar texto del PDF: {e}")
-
-    # ===============================================
-    # 🎯 NUEVA FUNCIÓN PARA EXTRAER CÓDIGOS ESPECÍFICOS (BASADA EN TU SCRIPT ORIGINAL)
-    # ===============================================
-    def _extract_product_codes_from_page(self):
-        """
-        Extrae y limpia el texto de la primera página para obtener solo los códigos de producto.
-        """
-        if not self.page_1_text:
-            return "No hay contenido en Pág. 1"
-
-        full_text = self.page_1_text.strip()
-
-        # 1. Primera Limpieza: Extraer el Bloque de Detalles (Flexible)
-        # Busca el bloque que comienza en 'Adic.*' y termina en 'Referencias:' O 'MONTO NETO'.
-        # re.DOTALL: permite que . coincida con saltos de línea.
-        block_pattern = r"Adic\.\*\s*(.*?)\s*(?:Referencias:|MONTO NETO)"
-        block_match = re.search(block_pattern, full_text, re.DOTALL)
-
-        extracted_details = ""
-        if block_match:
-            # group(1) contiene el contenido capturado (.*?)
-            extracted_details = block_match.group(1).strip()
-        else:
-            return "Bloque Adic.* no encontrado"
-
-        # 2. Segunda Limpieza: Extraer Códigos de Producto (SAT-DUST, SVSERV_5000, etc.)
-        # Patrón: inicio de línea (^), guion y espacio (- ), luego captura la primera palabra (\S+).
-        code_pattern = r"^- \s*(\S+)\s*"
-
-        # re.MULTILINE: permite que ^ funcione al inicio de cada línea.
-        product_codes = re.findall(
-            code_pattern, extracted_details, re.MULTILINE)
-
-        # 3. Formatear la salida final
-        if not product_codes:
-            return "No se encontraron códigos"
-
-        # Unimos los códigos con un separador simple (ej: ' | ') para el Excel
-        return " | ".join(product_codes)
-
-    # ===============================================
-    # MÉTODOS EXISTENTES
-    # ===============================================
-
-    def _parse_date(self, date_match, date_format_type):
-        """ Método privado para parsear la fecha basándose en el tipo de formato. """
-        extracted_date = "Error de Formato (Parseo)"
-        if date_format_type == "LONG_FORMAT":
-            try:
-                day = date_match.group(1)
-                month_es = date_match.group(2)
-                year = date_match.group(3)
-                try:
-                    date_str = f"{day} de {month_es} de {year}"
-                    date_obj = datetime.strptime(date_str, '%d de %B de %Y')
-                except ValueError:
-                    month_es_lower = month_es.lower()
-                    month_en = MONTH_MAPPING.get(month_es_lower, month_es)
-                    date_str = f"{day} of {month_en} of {year}"
-                    date_obj = datetime.strptime(date_str, '%d of %B of %Y')
-                extracted_date = date_obj.strftime('%d-%m-%y')
-            except Exception:
-                extracted_date = "Error de Formato (Largo Fallido)"
-        elif date_format_type == "DD_MM_YY":
-            try:
-                day = date_match.group(1).zfill(2)
-                month = date_match.group(2).zfill(2)
-                year = date_match.group(3)
-                if len(year) == 2:
-                    year = f"20{year}"
-                date_str = f"{day}-{month}-{year}"
-                date_obj = datetime.strptime(date_str, '%d-%m-%Y')
-                extracted_date = date_obj.strftime('%d-%m-%y')
-            except Exception:
-                extracted_date = "Error de Formato (Corto Fallido)"
-        return extracted_date
-
-    def _try_find(self, field_name):
-        """ Método privado que prueba secuencialmente los patrones para un campo. """
-        patterns = EXTRACTION_RULES.get(field_name, [])
-        for pattern in patterns:
-            if isinstance(pattern, dict):
-                regex = pattern.get("regex")
-            else:
-                regex = pattern
-
-            search_flags = re.IGNORECASE if field_name not in [
-                "DESCRIPTION"] else 0
-            match = re.search(regex, self.text, search_flags)
-
-            if match:
-                result = match.group(1).strip() if len(
-                    match.groups()) > 0 else ""
-                # La limpieza crítica de CLIENTE ahora se hace en _find_client_in_text.
-                return result, match, pattern
-        return "No encontrado", None, None
-
-    def extract_all(self):
-        """Método principal que ejecuta todas las extracciones."""
-
-        # 1. CLIENTE (Usando la función externa)
-        extracted_name = _find_client_in_text(self.text, EXTRACTION_RULES)
-
-        # 2. NÚMERO
-        extracted_number, _, _ = self._try_find("NUMBER")
-        # 3. FECHA
-        extracted_date = "No encontrado"
-        _, date_match, date_rule = self._try_find("DATE")
-        if date_match and date_rule:
-            extracted_date = self._parse_date(date_match, date_rule["format"])
-        # 4. TOTAL
-        extracted_total, _, _ = self._try_find("TOTAL")
-        # 5. DESCRIPCIÓN
-        extracted_description, _, _ = self._try_find("DESCRIPTION")
-
-        if extracted_description == "No encontrado":
-            extracted_description = "Documento Genérico (Default)"
-
-        # 🎯 6. CÓDIGOS DE PRODUCTO (NUEVO)
-        extracted_product_codes = self._extract_product_codes_from_page()
-
-        # Retorna el diccionario de resultados
-        return {
-            "CLIENT": extracted_name,
-            "DATE": extracted_date,
-            "NUMBER": extracted_number,
-            "DOLLARS": "",
-            "PESOS": extracted_total,
-            "EUROS": "",
-            "DESCRIPTION": extracted_description,
-            "PRODUCT_CODES": extracted_product_codes  # 🎯 Nuevo campo
-        }
+@st.cache_resource
+def _process_pool_state():
+    """
+    Estado del pool de procesos compartido por todos los clics y sesiones: el pool se
+    crea la primera vez que un lote lo necesita (levantar procesos cuesta cientos de ms)
+    y se cierra al terminar el servidor.
+    """
+    return {"lock": threading.Lock(), "executor": None, "version": None}
 
 
-# ===============================================
-# FUNCIÓN DE EXTRACCIÓN DOCX
-# ===============================================
+def _process_pool():
+    """
+    Devuelve el pool de procesos, creando uno nuevo si extraccion.py cambió desde que se
+    creó (sus procesos tienen cargado el código anterior). Los procesos se inician con "spawn":
+    hacer fork del servidor de Streamlit (con varios hilos) puede dejar locks tomados en
+    el proceso hijo.
+    """
+    state = _process_pool_state()
+    version = os.path.getmtime(extraccion.__file__)
+    with state["lock"]:
+        if state["executor"] is None or state["version"] != version:
+            if state["executor"] is not None:
+                # Sin cancel_futures: otra sesión puede estar usando el pool anterior, que
+                # termina sus lotes y luego se cierra (ya no recibe lotes nuevos).
+                state["executor"].shutdown(wait=False)
+            executor = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn"))
+            atexit.register(executor.shutdown, wait=False, cancel_futures=True)
+            state["executor"] = executor
+            state["version"] = version
+        return state["executor"]
+
+
+def _discard_process_pool(executor):
+    """ Cierra un pool que ya no funciona para que el próximo lote cree uno nuevo. """
+    state = _process_pool_state()
+    executor.shutdown(wait=False, cancel_futures=True)
+    with state["lock"]:
+        if state["executor"] is executor:
+            state["executor"] = None
+
+
+def _run_serial(extract, payloads):
+    """ Aplica `extract` a cada archivo en este proceso, en orden. """
+    results = []
+    for index, payload in enumerate(payloads, start=1):
+        results.append(extract(payload))
+        if index % GC_EVERY_FILES == 0:
+            gc.collect()
+    return results
+
+
+def _run_extraction(extract, payloads):
+    """
+    Aplica `extract` a cada archivo (bytes) y devuelve los resultados en el mismo orden.
+    Con muchos archivos se reparten entre procesos (la extracción usa CPU y cada archivo
+    es independiente); con pocos archivos (o una sola CPU) levantar procesos cuesta más
+    que extraer, así que se hace en serie.
+    """
+    workers = min(os.cpu_count() or 1, len(payloads))
+    if len(payloads) < PARALLEL_MIN_FILES or workers < 2:
+        return _run_serial(extract, payloads)
 
-def extract_data_from_docx(docx_file):
+    executor = _process_pool()
+    try:
+        return list(executor.map(extract, payloads))
+    except BrokenProcessPool:
+        # Un proceso murió (ej: sin memoria): se descarta el pool y el lote se extrae en
+        # serie, en vez de perder todo el procesamiento.
+        _discard_process_pool(executor)
+        st.warning("Un proceso de extracción se detuvo inesperadamente; "
+                   "los archivos se procesan de nuevo uno por uno.")
+        return _run_serial(extract, payloads)
+    except CancelledError:
+        # Otra sesión encontró roto este mismo pool y lo cerró mientras este lote esperaba
+        # su turno: también se extrae en serie.
+        return _run_serial(extract, payloads)
+
+
+@st.cache_resource
+def _results_cache(kind):
     """
-    Extrae el número y fecha de cotización de un archivo DOCX.
+    Resultados de extracción por hash del contenido, uno por tipo de archivo ("pdf",
+    "docx"). Vive fuera del script (Streamlit re-ejecuta el módulo en cada interacción)
+    y es compartido entre sesiones: el mismo archivo siempre produce el mismo resultado.
     """
-    # Patrón: COTIZACIÓN # <CÓDIGO>/<TEXTO>, <FECHA>
-    QUOTE_PATTERN = r"COTIZACI[ÓO]N\s*#\s*([A-Z0-9]+)\/?[A-Z]*,\s*(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{2,4})"
+    return {}
 
-    extracted_quotation = {
-        "QUOTATION_NUMBER": "No encontrado",
-        "QUOTATION_DATE": "No encontrado",
-    }
 
-    try:
-        # Load the document from the in-memory BytesIO object
-        document = docx.Document(docx_file)
-
-        # Leemos todo el texto del documento
-        full_text = []
-        for paragraph in document.paragraphs:
-            full_text.append(paragraph.text)
-        # Unir y limpiar el texto
-        text = " ".join(full_text)
-        text = re.sub(r'\s+', ' ', text).strip()
-
-        # 1. Extracción del Número y Fecha de Cotización
-        match = re.search(QUOTE_PATTERN, text, re.IGNORECASE)
-        if match:
-            quotation_number = match.group(1).strip()
-            quotation_date_raw = match.group(2).strip()
-            formatted_date = quotation_date_raw
-
-            # --- LÓGICA DE LIMPIEZA ---
-            quotation_number = re.sub(
-                r"^CB", "", quotation_number, flags=re.IGNORECASE).strip()
-
-            try:  # Intentar formatear la fecha
-                date_obj = datetime.strptime(quotation_date_raw, '%d/%m/%Y')
-                formatted_date = date_obj.strftime('%d-%m-%y')
-            except ValueError:
-                try:
-                    date_obj = datetime.strptime(
-                        quotation_date_raw, '%d-%m-%Y')
-                    formatted_date = date_obj.strftime('%d-%m-%y')
-                except ValueError:
-                    try:
-                        date_obj = datetime.strptime(
-                            quotation_date_raw, '%d/%m/%y')
-                        formatted_date = date_obj.strftime('%d-%m-%y')
-                    except ValueError:
-                        pass  # Si falla, se deja la cadena original.
-
-            extracted_quotation["QUOTATION_NUMBER"] = quotation_number
-            extracted_quotation["QUOTATION_DATE"] = formatted_date
-
-        return extracted_quotation
+@st.cache_resource
+def _results_cache_lock():
+    """ Lock del caché de resultados (el script se re-ejecuta, el lock debe sobrevivir). """
+    return threading.Lock()
 
-    except ImportError:
-        st.error("Error: La librería 'python-docx' (import docx) no está instalada. Es necesaria para procesar archivos Word.")
-        return extracted_quotation
-    except Exception as e:
-        st.warning(
-            f"Error al procesar el archivo DOCX: {docx_file.name}. Detalles: {e}")
-        return extracted_quotation
 
+def _content_key(payload):
+    """ Hash corto y rápido del contenido del archivo (clave del caché de resultados). """
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
 
-# ===============================================
-# INTERFAZ STREAMLIT (Lógica de la Aplicación Web)
-# ===============================================
+
+def _extract_cached(kind, extract, payloads):
+    """
+    Aplica `extract` a una lista de archivos (bytes) y devuelve los resultados en el mismo
+    orden. Solo se extraen los archivos que no están en el caché por contenido: volver a
+    pulsar "Procesar" con los mismos archivos no vuelve a parsearlos, y un archivo repetido
+    en el lote se extrae una vez. Si quedan muchos por extraer se reparten entre procesos
+    (ver _run_extraction).
+    """
+    cache = _results_cache(kind)
+    cache_lock = _results_cache_lock()
+    cache_keys = [_content_key(payload) for payload in payloads]
+
+    # El caché es compartido por todas las sesiones (cada una en su propio hilo)
+    with cache_lock:
+        batch_results = {key: cache[key] for key in cache_keys if key in cache}
+    missing = {key: payload for key, payload in zip(cache_keys, payloads)
+               if key not in batch_results}
+
+    if missing:
+        # La extracción corre fuera del lock: otras sesiones pueden leer mientras tanto
+        batch_results.update(zip(missing, _run_extraction(extract, list(missing.values()))))
+        del missing
+
+    with cache_lock:
+        # Los archivos del lote pasan al final (los más recientes) y se descartan los
+        # resultados más antiguos de otros lotes para acotar la memoria del servidor
+        for key, result in batch_results.items():
+            cache.pop(key, None)
+            cache[key] = result
+        while len(cache) > RESULTS_CACHE_MAX_ENTRIES:
+            oldest_key = next(iter(cache))
+            if oldest_key in batch_results:
+                break
+            del cache[oldest_key]
+
+    # Copias: main() completa cada fila y no debe modificar lo guardado en el caché
+    return [dict(batch_results[key]) for key in cache_keys]
+
+
+def extract_data_from_pdfs(pdf_payloads):
+    """
+    Extrae una lista de PDFs (bytes) y devuelve los resultados en el mismo orden
+    (usa el caché por contenido).
+    """
+    return _extract_cached("pdf", extract_pdf, pdf_payloads)
 
 
-def extract_data_from_pdf(pdf_file):
-    """ Función wrapper para la extracción de PDF. """
-    try:
-        extractor = FacturaExtractor(pdf_file)
-        return extractor.extract_all()
-    except Exception as e:
-        return {
-            "CLIENT": f"ERROR: No se pudo procesar - {e}",
-            "DATE": "N/A", "NUMBER": "N/A", "DOLLARS": "N/A",
-            "PESOS": "N/A", "EUROS": "N/A", "DESCRIPTION": "N/A",
-            "PRODUCT_CODES": "N/A"  # 🎯 Se añade el nuevo campo al retorno de error
-        }
+def extract_data_from_docxs(docx_payloads):
+    """
+    Extrae una lista de DOCX (bytes) y devuelve los resultados en el mismo orden, con el
+    error de cada archivo en "LOAD_ERROR" (usa el caché por contenido).
+    """
+    if not _docx_available():
+        return [{**EMPTY_QUOTATION, "LOAD_ERROR": None} for _ in docx_payloads]
+    return _extract_cached("docx", extract_docx, docx_payloads)
 
 
 def main():
@@ -344,24 +223,34 @@ def main():
         key="docx_uploader"
     )
 
+    # CSV evita el ZIP/XML/estilos del .xlsx cuando no se necesita un libro de Excel
+    output_format = st.radio(
+        "Formato del archivo consolidado:",
+        ["xlsx", "csv"],
+        horizontal=True,
+        key="output_format"
+    )
+
     # === PROCESAMIENTO ===
     if uploaded_pdfs or uploaded_docs:
         if st.button("Procesar y Consolidar en Excel", type="primary"):
 
-            # Almacenamiento consolidado. La clave es el CLIENTE
-            all_data = {}
-
-            # NUEVO: Lista para mantener el orden de las claves de los clientes
-            # (El orden de los PDFs define el orden de las filas)
-            pdf_client_keys = []
+            # Almacenamiento consolidado: una fila por PDF con cliente, en el orden de
+            # carga (el orden de los PDFs define el orden de las filas). La fusión DOCX
+            # es por posición, así que no hace falta indexar las filas por cliente.
+            pdf_rows = []
 
             # --- 1. PROCESAR PDFs (Fuente principal de filas) ---
             if uploaded_pdfs:
                 with st.spinner(f"Iniciando extracción de {len(uploaded_pdfs)} Facturas (PDF)..."):
-                    for uploaded_pdf in uploaded_pdfs:
+                    pdf_results = extract_data_from_pdfs(
+                        [uploaded_pdf.getvalue() for uploaded_pdf in uploaded_pdfs])
+
+                    for uploaded_pdf, result in zip(uploaded_pdfs, pdf_results):
                         try:
-                            pdf_data = io.BytesIO(uploaded_pdf.getvalue())
-                            result = extract_data_from_pdf(pdf_data)
+                            if result.get("LOAD_ERROR"):
+                                st.warning(
+                                    f"Error al cargar texto del PDF {uploaded_pdf.name}: {result['LOAD_ERROR']}")
 
                             # ⚠️ CLAVE DE FUSIÓN: Nombre del Cliente (normalizado)
                             merge_key = result["CLIENT"].upper().strip()
@@ -369,23 +258,12 @@ def main():
                             # Solo agregamos si se encontró el cliente en el PDF
                             if merge_key != "NO ENCONTRADO" and merge_key != "":
 
-                                # Si ya existe el cliente (duplicado), le agregamos un sufijo para que sea único
-                                unique_merge_key = merge_key
-                                count = 1
-                                while unique_merge_key in all_data:
-                                    unique_merge_key = f"{merge_key}_{count}"
-                                    count += 1
-
-                                # Guardar la clave única para usarla en la fusión DOCX
-                                pdf_client_keys.append(unique_merge_key)
-
-                                # Añadimos placeholders para las columnas de cotización
-                                placeholder_quote_data = {
-                                    "QUOTATION_NUMBER": "No DOCX adjunto",
-                                    "QUOTATION_DATE": "No DOCX adjunto"
-                                }
-                                all_data[unique_merge_key] = {
-                                    **result, **placeholder_quote_data, "FILE_NAME": uploaded_pdf.name}
+                                # El resultado ya es una copia propia (no la del caché): se
+                                # completa en el lugar con los placeholders de cotización.
+                                result["QUOTATION_NUMBER"] = "No DOCX adjunto"
+                                result["QUOTATION_DATE"] = "No DOCX adjunto"
+                                result["FILE_NAME"] = uploaded_pdf.name
+                                pdf_rows.append(result)
                             else:
                                 st.warning(
                                     f"PDF ignorado: {uploaded_pdf.name}. No se pudo extraer el CLIENTE para generar la fila.")
@@ -398,58 +276,41 @@ def main():
             if uploaded_docs:
                 with st.spinner(f"Iniciando extracción de {len(uploaded_docs)} Cotizaciones (DOCX) y fusionando por orden..."):
 
-                    # Iteramos sobre los DOCXs, y usamos el índice para obtener la clave del PDF correspondiente
+                    # Iteramos sobre los DOCXs, y usamos el índice para obtener la fila del PDF correspondiente
                     num_docs_to_process = min(
-                        len(uploaded_docs), len(pdf_client_keys))
+                        len(uploaded_docs), len(pdf_rows))
 
-                    for i in range(num_docs_to_process):
+                    # Se extraen todos juntos (en paralelo si son muchos) y se fusionan en orden
+                    docx_results = extract_data_from_docxs(
+                        [uploaded_docs[i].getvalue() for i in range(num_docs_to_process)])
+
+                    for i, quote_result in enumerate(docx_results):
                         uploaded_doc = uploaded_docs[i]
-                        # Obtenemos la clave del PDF correspondiente
-                        pdf_key_to_update = pdf_client_keys[i]
+                        # Obtenemos la fila del PDF correspondiente
+                        pdf_row = pdf_rows[i]
 
                         try:
-                            doc_data = io.BytesIO(uploaded_doc.getvalue())
-                            quote_result = extract_data_from_docx(doc_data)
+                            load_error = quote_result.pop("LOAD_ERROR")
+                            if load_error:
+                                st.warning(
+                                    f"Error al procesar el archivo DOCX: {uploaded_doc.name}. Detalles: {load_error}")
 
-                            # ¡FUSIÓN EXITOSA FORZADA! Actualizamos la fila del PDF usando la clave secuencial
-                            all_data[pdf_key_to_update].update(quote_result)
+                            # ¡FUSIÓN EXITOSA FORZADA! Actualizamos la fila del PDF en la misma posición
+                            pdf_row.update(quote_result)
 
-                            original_client_name = all_data[pdf_key_to_update]['CLIENT']
+                            original_client_name = pdf_row['CLIENT']
                             st.success(
                                 f"DOCX fusionado (Secuencial): {uploaded_doc.name} se consolidó con la fila del PDF '{original_client_name}'.")
 
-                        except KeyError:
-                            # Esto no debería pasar si pdf_key_to_update está en pdf_client_keys
-                            st.error(
-                                f"Error interno: La clave '{pdf_key_to_update}' no existe en all_data.")
                         except Exception as e:
                             st.warning(
                                 f"Error en DOCX {uploaded_doc.name} (Fallo Secuencial): {e}")
 
-                    if len(uploaded_docs) > len(pdf_client_keys):
+                    if len(uploaded_docs) > len(pdf_rows):
                         st.info(
-                            f"Se ignoraron {len(uploaded_docs) - len(pdf_client_keys)} DOCXs porque no había más PDFs para fusionar.")
-
-            # --- 3. CONSOLIDAR DATAFRAME ---
-
-            # Mapear el diccionario de resultados a una lista, manteniendo el orden de las claves.
-            consolidated_data = [all_data[key] for key in pdf_client_keys]
-
-            # A. Crear el DataFrame final
-            # Creamos el DataFrame con todas las columnas
-            df = pd.DataFrame(consolidated_data)
-
-            # 🎯 MODIFICACIÓN CLAVE: Mover PRODUCT_CODES a DESCRIPTION
-            # -----------------------------------------------------------
-            # Usamos la columna PRODUCT_CODES para sobrescribir DESCRIPTION
-            df['DESCRIPTION'] = df['PRODUCT_CODES']
+                            f"Se ignoraron {len(uploaded_docs) - len(pdf_rows)} DOCXs porque no había más PDFs para fusionar.")
 
-            # Eliminamos la columna PRODUCT_CODES ya que su contenido ha sido movido.
-            df = df.drop(columns=['PRODUCT_CODES'])
-            # -----------------------------------------------------------
-
-            # Limpiar claves de sufijos si se duplicaron
-            df['CLIENT'] = df['CLIENT'].apply(lambda x: x.split('_')[0])
+            # --- 3. CONSOLIDAR TABLA ---
 
             # Definimos el orden de las columnas FINAL (sin PRODUCT_CODES)
             column_order = [
@@ -458,47 +319,69 @@ def main():
                 "DESCRIPTION", "FILE_NAME"
             ]
 
-            # Reindexamos el DataFrame para aplicar el orden final
-            df = df.reindex(columns=column_order)
-
-            st.subheader("✅ Datos Consolidados (Vista Previa)")
-            st.dataframe(df, width='stretch')
-
-            # B. Crear el archivo Excel en memoria
-            output = io.BytesIO()
-
-            def clean_total(x):
-                if isinstance(x, str):
-                    if x in ["No encontrado", "N/A", "Documento Genérico (Default)", "No DOCX adjunto", "No hay contenido en Pág. 1", "Bloque Adic.* no encontrado", "No se encontraron códigos"]:
-                        return x
-                    # Remueve el punto como separador de miles
-                    cleaned_x = x.replace('.', '')
-                    # Reemplaza la coma por punto para decimales (formato float)
-                    cleaned_x = cleaned_x.replace(',', '.')
-                    try:
-                        return float(cleaned_x)
-                    except ValueError:
-                        return x
-                # Para números directos, los devuelve tal cual
-                return x
-
-            # Aplicar limpieza a la columna PESOS
-            df['PESOS'] = df['PESOS'].apply(clean_total)
-
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                df.to_excel(writer, index=False,
-                            sheet_name='Datos Consolidación')
-            output.seek(0)
+            # 🎯 MODIFICACIÓN CLAVE: la columna DESCRIPTION se llena con PRODUCT_CODES
+            source_columns = {"DESCRIPTION": "PRODUCT_CODES"}
+
+            # A. Crear la tabla final
+            # Para unas pocas filas pandas es puro overhead: se arma la tabla como
+            # dict de columnas (dict de listas) ya en el orden final y se escribe directo.
+            table = {
+                column: [row.get(source_columns.get(column, column))
+                         for row in pdf_rows]
+                for column in column_order
+            }
+
+            # Filas en el orden de column_order, para CSV y Excel
+            rows = list(zip(*table.values()))
+
+            # B. Crear el archivo en memoria
+            if output_format == "csv":
+                csv_output = io.StringIO()
+                csv_writer = csv.writer(csv_output)
+                csv_writer.writerow(column_order)
+                csv_writer.writerows(rows)
+                # utf-8-sig: Excel reconoce los acentos al abrir el CSV
+                file_data = csv_output.getvalue().encode('utf-8-sig')
+                mime = "text/csv"
+            else:
+                import xlsxwriter
+
+                output = io.BytesIO()
+
+                # Escritura directa con xlsxwriter: evita la capa de formateo por celda de
+                # pandas (ExcelFormatter), que domina el costo en hojas pequeñas.
+                # constant_memory: cada fila se vuelca al terminar de escribirla (las filas
+                # ya van en orden), en vez de guardar toda la hoja en memoria hasta close().
+                workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+                worksheet = workbook.add_worksheet('Datos Consolidación')
+                # Mismo estilo de encabezado que generaba pandas con to_excel
+                header_format = workbook.add_format(
+                    {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+                worksheet.write_row(0, 0, column_order, header_format)
+                for row_num, row in enumerate(rows, start=1):
+                    worksheet.write_row(row_num, 0, row)
+                workbook.close()
+                # getvalue() entrega el buffer sin mover el puntero ni hacer otra lectura
+                file_data = output.getvalue()
+                mime = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
 
             # C. Botón de descarga
-            st.subheader("⬇️ Archivo Excel Consolidado Generado")
+            st.subheader("⬇️ Archivo Consolidado Generado")
             st.download_button(
-                label="Descargar Excel Consolidado",
-                data=output.read(),
-                file_name=f"Consolidado_Facturas_Cotizaciones_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                label=f"Descargar Consolidado (.{output_format})",
+                data=file_data,
+                file_name=f"Consolidado_Facturas_Cotizaciones_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{output_format}",
+                mime=mime,
                 key="download_button"
             )
+
+            # D. Vista previa (después del botón, para que la descarga aparezca primero).
+            # Solo las primeras filas: el costo no crece con el tamaño del lote.
+            st.subheader("✅ Datos Consolidados (Vista Previa)")
+            st.caption(f"{len(rows)} filas totales (se muestran hasta {PREVIEW_MAX_ROWS})")
+            # Tabla estática: evita montar la grilla interactiva para una vista previa
+            st.table({column: values[:PREVIEW_MAX_ROWS]
+                      for column, values in table.items()})
             st.balloons()
 
 
@@ -0,0 +1,435 @@
+# Lógica de extracción de Facturas (PDF) y Cotizaciones (DOCX), sin llamadas a Streamlit.
+# Vive en un módulo propio para que los procesos del pool reciban las funciones por un
+# nombre estable: Streamlit re-ejecuta Angela_app.py como un __main__ nuevo en cada
+# interacción, y pickle no encuentra las funciones de una ejecución anterior.
+import re  # Para usar Expresiones Regulares (Regex)
+import io
+import calendar
+# ⚠️ pypdfium2 y python-docx se importan dentro de las funciones que los usan: importar
+# este módulo no paga su importación hasta extraer el primer archivo.
+
+# ⚠️ CONFIGURACIÓN GLOBAL (Mapeo de meses)
+# Se mantiene fuera de la clase ya que son constantes de configuración.
+# Mes en español -> número: evita depender del locale del servidor (setlocale es
+# global al proceso y en Streamlit Cloud no existe es_ES).
+MONTH_MAPPING = {
+    'enero': 1, 'febrero': 2, 'marzo': 3,
+    'abril': 4, 'mayo': 5, 'junio': 6,
+    'julio': 7, 'agosto': 8, 'septiembre': 9, 'setiembre': 9,
+    'octubre': 10, 'noviembre': 11, 'diciembre': 12
+}
+
+# Valores de cotización cuando no hay datos (DOCX sin cotización o ilegible)
+EMPTY_QUOTATION = {
+    "QUOTATION_NUMBER": "No encontrado",
+    "QUOTATION_DATE": "No encontrado",
+}
+
+# Reglas de Extracción Centralizadas (para PDF y DOCX)
+EXTRACTION_RULES = {
+    "CLIENT": [
+        # Regla 1 (MÁXIMA PRECISIÓN para Razón Social):
+        r"(?:SEÑOR\s*\(?ES\)?\s*:\s*)([^\n\r]+?)(?=\s*(?:R\.?U\.?T\.|GIRO|DIRECCI[ÓO]N|FECHA|COMUNA|[\n\r]|$))",
+        # Regla 2 (Fallback si no hay R.U.T. cerca): Busca SR(A): NOMBRE...
+        r"(?:SR\.\(?A\)?[\s:]*)([^\n\r]+?)(?:\s+RUT|[\n\r]|$)",
+        # Regla 3 (Flexible): Fallback por si no tiene prefijo formal
+        r"(?:SR\.\(?A\)?|Hola|Estimado\s*:\s*)?([^\n\r]+?)(?:\s+RUT|[\n\r]|$)"
+    ],
+    "NUMBER": [r"N[°º]\s*:\s*(\d+)", r"N[°º]\s*(\d+)"],
+    "DATE": [
+        {"regex": r"Fecha\s+(?:de\s+)?Emisi[óo]n\s*:\s*(\d{1,2})\s+de\s+(\w+)\s+(?:del|de)\s+(\d{4})",
+         "format": "LONG_FORMAT"},
+        {"regex": r"Fecha\s*:\s*(\d{1,2})[\s\-\/](\d{1,2})[\s\-\/](\d{2,4})",
+         "format": "DD_MM_YY"}
+    ],
+    "TOTAL": [r"TOTAL\s+\$\s*([\d\.,]+)", r"Total\s+Cuenta\s+Única\s+Telefónica\s+\$\s*([\d\.,]+)"],
+    "DESCRIPTION": [r"(BOLETA\s+ELECTRONICA)", r"(GUIA\s+DE\s+DESPACHO\s+ELECTRONICA)", r"([A-Z0-9]{2,}[-][A-Z0-9]{2,})", r"\b([A-Z]{3,}\d{2,})\b", r"(SII[^\n\r]+SANTIAGO)"]
+}
+
+
+def _compile_rules(rules):
+    """ Compila una sola vez las reglas de extracción (DESCRIPTION distingue mayúsculas). """
+    compiled = {}
+    for field_name, patterns in rules.items():
+        flags = 0 if field_name == "DESCRIPTION" else re.IGNORECASE
+        compiled[field_name] = [
+            {**pattern, "regex": re.compile(pattern["regex"], flags)}
+            if isinstance(pattern, dict) else re.compile(pattern, flags)
+            for pattern in patterns
+        ]
+    return compiled
+
+
+# Reglas precompiladas: evita re-parsear/buscar en la caché de `re` en cada PDF
+COMPILED_RULES = _compile_rules(EXTRACTION_RULES)
+# Campos que deciden el corte temprano de lectura de páginas. DESCRIPTION no participa:
+# en main() se reemplaza por PRODUCT_CODES (que sale de la primera página).
+EARLY_EXIT_FIELDS = ("CLIENT", "NUMBER", "DATE", "TOTAL")
+# Caracteres del final de la página anterior que se revisan junto con la nueva al decidir
+# el corte temprano (una coincidencia puede empezar en una página y terminar en la otra).
+PAGE_OVERLAP_CHARS = 256
+# Bloque de detalles de la Pág. 1: comienza en 'Adic.*' y termina en 'Referencias:' O
+# 'MONTO NETO'. re.DOTALL: permite que . coincida con saltos de línea.
+_PRODUCT_BLOCK_RE = re.compile(
+    r"Adic\.\*\s*(.*?)\s*(?:Referencias:|MONTO NETO)", re.DOTALL)
+# Código de producto: inicio de línea (^), guion y espacio (- ), luego la primera palabra (\S+).
+# re.MULTILINE: permite que ^ funcione al inicio de cada línea.
+_PRODUCT_CODE_RE = re.compile(r"^- \s*(\S+)\s*", re.MULTILINE)
+# Limpieza del nombre de cliente en una sola pasada: prefijo "SEÑOR(ES):"/"SR.(A)",
+# cola desde el R.U.T. y cualquier ":" suelto.
+_CLIENT_CLEAN_RE = re.compile(
+    r"^(?:SEÑOR\s*\(?ES\)?\s*:\s*|SR\.\(?A\)?[\s:]*)|\s*R\.?U\.?T\..*$|:", re.IGNORECASE)
+# Cotización (DOCX). Patrón: COTIZACIÓN # <CÓDIGO>/<TEXTO>, <FECHA>
+_QUOTE_RE = re.compile(
+    r"COTIZACI[ÓO]N\s*#\s*([A-Z0-9]+)\/?[A-Z]*,\s*(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{2,4})",
+    re.IGNORECASE)
+# Prefijo "CB" que se quita del número de cotización
+_CB_PREFIX_RE = re.compile(r"^CB", re.IGNORECASE)
+# Fecha de la cotización (DOCX): día, separador, mes (mismo separador) y año
+_DOCX_DATE_RE = re.compile(r"(\d{1,2})([/-])(\d{1,2})\2(\d{2,4})")
+# Monto en formato chileno: el punto separa miles y la coma separa decimales
+_AMOUNT_TRANSLATION = str.maketrans({'.': None, ',': '.'})
+
+
+# ===============================================
+# FUNCIONES AUXILIARES DE EXTRACCIÓN Y LIMPIEZA
+# ===============================================
+
+def _find_client_in_text(text, rules):
+    """ Busca el nombre del cliente usando las reglas de FacturaExtractor. """
+    patterns = rules.get("CLIENT", [])
+    for pattern in patterns:
+        match = pattern.search(text)
+        if match:
+            result = match.group(1).strip() if len(match.groups()) > 0 else ""
+            # --- LIMPIEZA CRÍTICA ---
+            result = _CLIENT_CLEAN_RE.sub("", result).strip()
+            return result
+    return "No encontrado"
+
+
+def _top_rule_matches_before_end(field_name, text):
+    """
+    Indica si la primera coincidencia de la regla de mayor prioridad del campo termina
+    antes del final de `text`: si es así, agregar más texto no puede cambiar ese valor.
+    """
+    rule = COMPILED_RULES[field_name][0]
+    regex = rule["regex"] if isinstance(rule, dict) else rule
+    match = regex.search(text)
+    return match is not None and match.end() < len(text)
+
+
+def clean_total(x):
+    """ Convierte un monto en formato chileno ('1.234.567' / '10,5') a número. """
+    if isinstance(x, str):
+        # Una sola pasada: quita el punto de miles y cambia la coma decimal por punto
+        cleaned_x = x.translate(_AMOUNT_TRANSLATION)
+        try:
+            # Los montos enteros quedan como int (sin ".0" en el CSV)
+            return int(cleaned_x)
+        except ValueError:
+            pass
+        try:
+            return float(cleaned_x)
+        except ValueError:
+            # Textos como "No encontrado" o "N/A" se devuelven tal cual
+            return x
+    # Para números directos, los devuelve tal cual
+    return x
+
+
+def _format_date(day, month, year):
+    """
+    Devuelve la fecha como 'dd-mm-yy', o None si no existe (mes fuera de rango,
+    31 de febrero...). Valida con calendar en vez de capturar el error de datetime().
+    """
+    if month is None or not 1 <= month <= 12 or year < 1:
+        return None
+    if not 1 <= day <= calendar.monthrange(year, month)[1]:
+        return None
+    return f"{day:02d}-{month:02d}-{year % 100:02d}"
+
+
+# ===============================================
+# CLASE DE EXTRACCIÓN PDF
+# ===============================================
+
+class FacturaExtractor:
+    """ Encapsula la lógica y las reglas de extracción para un tipo de documento PDF. """
+
+    # Se crea una instancia por PDF: sin __dict__ por instancia y con acceso directo
+    __slots__ = ("text", "page_1_text", "load_error")
+
+    def __init__(self, pdf_file):
+        """Inicializa el extractor leyendo y limpiando el texto del PDF."""
+
+        # 🎯 Almacenamos el texto completo (limpiado de espacios) y el texto de la
+        # primera página (para la extracción de códigos específicos).
+        # pypdfium2 (motor C++ de PDFium) extrae solo la capa de texto, sin el
+        # análisis de layout que hacía pdfplumber/pdfminer.
+        self.text = ""
+        self.page_1_text = ""
+        # El error de carga se guarda (no se muestra aquí): la extracción puede correr
+        # en un proceso del pool, sin contexto de Streamlit; main() lo muestra.
+        self.load_error = None
+        try:
+            import pypdfium2 as pdfium
+
+            pdf = pdfium.PdfDocument(pdf_file)
+            try:
+                # Las páginas se leen una a una (PDFium solo parsea las que se piden) y se
+                # deja de leer cuando ninguna página siguiente puede cambiar el resultado.
+                pages = []
+                pending_fields = set(EARLY_EXIT_FIELDS)
+                previous_tail = ""
+                for page_index, page in enumerate(pdf):
+                    textpage = page.get_textpage()
+                    page_text = textpage.get_text_range()
+                    # Se libera la memoria nativa de la página apenas se lee su texto,
+                    # en vez de acumular todas las páginas hasta pdf.close()
+                    textpage.close()
+                    page.close()
+
+                    # Texto de la Primera Página (para los códigos específicos)
+                    if page_index == 0:
+                        self.page_1_text = page_text
+
+                    # Texto Completo (para campos generales como total, fecha, etc.)
+                    # split() sin argumentos corta en cualquier blanco (\n, \r, \t, \xa0...) y
+                    # descarta los extremos: colapsa y recorta en una sola pasada, sin regex.
+                    cleaned_page = " ".join(page_text.split())
+                    if not cleaned_page:
+                        continue
+                    pages.append(cleaned_page)
+
+                    # Solo se busca en la página nueva (más el final de la anterior, por si la
+                    # coincidencia cruza el salto de página): recorrer todo el texto leído en
+                    # cada página hacía crecer el costo con el cuadrado de las páginas.
+                    window = f"{previous_tail} {cleaned_page}" if previous_tail else cleaned_page
+                    previous_tail = cleaned_page[-PAGE_OVERLAP_CHARS:]
+                    candidates = [field_name for field_name in pending_fields
+                                  if _top_rule_matches_before_end(field_name, window)]
+                    if candidates:
+                        # Se confirma sobre todo el texto leído (puede haber una coincidencia
+                        # anterior que aún no termina); pasa pocas veces por campo.
+                        text_so_far = " ".join(pages)
+                        pending_fields.difference_update(
+                            field_name for field_name in candidates
+                            if _top_rule_matches_before_end(field_name, text_so_far))
+                        if not pending_fields:
+                            break
+                self.text = " ".join(pages)
+            finally:
+                pdf.close()
+
+        except Exception as e:
+            self.text = ""
+            self.page_1_text = ""
+            self.load_error = str(e)
+
+    # ===============================================
+    # 🎯 NUEVA FUNCIÓN PARA EXTRAER CÓDIGOS ESPECÍFICOS (BASADA EN TU SCRIPT ORIGINAL)
+    # ===============================================
+    def _extract_product_codes_from_page(self):
+        """
+        Extrae y limpia el texto de la primera página para obtener solo los códigos de producto.
+        """
+        if not self.page_1_text:
+            return "No hay contenido en Pág. 1"
+
+        full_text = self.page_1_text.strip()
+
+        # 1. Primera Limpieza: Extraer el Bloque de Detalles (Flexible)
+        block_match = _PRODUCT_BLOCK_RE.search(full_text)
+
+        extracted_details = ""
+        if block_match:
+            # group(1) contiene el contenido capturado (.*?)
+            extracted_details = block_match.group(1).strip()
+        else:
+            return "Bloque Adic.* no encontrado"
+
+        # 2. Segunda Limpieza: Extraer Códigos de Producto (SAT-DUST, SVSERV_5000, etc.)
+        # Unimos los códigos con un separador simple (ej: ' | ') para el Excel,
+        # recorriendo las coincidencias directamente sin armar la lista de findall.
+        product_codes = " | ".join(
+            m.group(1) for m in _PRODUCT_CODE_RE.finditer(extracted_details))
+
+        # 3. Formatear la salida final
+        if not product_codes:
+            return "No se encontraron códigos"
+
+        return product_codes
+
+    # ===============================================
+    # MÉTODOS EXISTENTES
+    # ===============================================
+
+    def _parse_date(self, date_match, date_format_type):
+        """ Método privado para parsear la fecha basándose en el tipo de formato. """
+        extracted_date = "Error de Formato (Parseo)"
+        if date_format_type == "LONG_FORMAT":
+            # Mes inexistente en MONTH_MAPPING -> None -> fecha inválida (sin excepciones)
+            formatted_date = _format_date(int(date_match.group(1)),
+                                          MONTH_MAPPING.get(date_match.group(2).lower()),
+                                          int(date_match.group(3)))
+            extracted_date = formatted_date or "Error de Formato (Largo Fallido)"
+        elif date_format_type == "DD_MM_YY":
+            year = date_match.group(3)
+            if len(year) == 2:
+                year = f"20{year}"
+            # Igual que el '%Y' de strptime: solo años de 4 dígitos
+            formatted_date = _format_date(int(date_match.group(1)),
+                                          int(date_match.group(2)),
+                                          int(year)) if len(year) == 4 else None
+            extracted_date = formatted_date or "Error de Formato (Corto Fallido)"
+        return extracted_date
+
+    def _try_find(self, field_name, capture=True):
+        """
+        Método privado que prueba secuencialmente los patrones para un campo.
+        Con capture=False no arma el texto del grupo 1 (quien llama solo usa el match).
+        """
+        patterns = COMPILED_RULES.get(field_name, [])
+        for pattern in patterns:
+            if isinstance(pattern, dict):
+                regex = pattern.get("regex")
+            else:
+                regex = pattern
+
+            match = regex.search(self.text)
+
+            if match:
+                if not capture:
+                    return None, match, pattern
+                result = match.group(1).strip() if len(
+                    match.groups()) > 0 else ""
+                # La limpieza crítica de CLIENTE ahora se hace en _find_client_in_text.
+                return result, match, pattern
+        return "No encontrado", None, None
+
+    def extract_all(self):
+        """
+        Método principal que ejecuta todas las extracciones.
+        DESCRIPTION se busca solo en las páginas leídas: si la lectura se cortó antes del
+        final, puede diferir de la del documento completo (main() la reemplaza por
+        PRODUCT_CODES).
+        """
+
+        # 1. CLIENTE (Usando la función externa)
+        extracted_name = _find_client_in_text(self.text, COMPILED_RULES)
+
+        # 2. NÚMERO
+        extracted_number, _, _ = self._try_find("NUMBER")
+        # 3. FECHA
+        extracted_date = "No encontrado"
+        _, date_match, date_rule = self._try_find("DATE", capture=False)
+        if date_match and date_rule:
+            extracted_date = self._parse_date(date_match, date_rule["format"])
+        # 4. TOTAL
+        extracted_total, _, _ = self._try_find("TOTAL")
+        # 5. DESCRIPCIÓN
+        extracted_description, _, _ = self._try_find("DESCRIPTION")
+
+        if extracted_description == "No encontrado":
+            extracted_description = "Documento Genérico (Default)"
+
+        # 🎯 6. CÓDIGOS DE PRODUCTO (NUEVO)
+        extracted_product_codes = self._extract_product_codes_from_page()
+
+        # Retorna el diccionario de resultados
+        return {
+            "CLIENT": extracted_name,
+            "DATE": extracted_date,
+            "NUMBER": extracted_number,
+            "DOLLARS": "",
+            # El monto se limpia aquí, una sola vez por PDF
+            "PESOS": clean_total(extracted_total),
+            "EUROS": "",
+            "DESCRIPTION": extracted_description,
+            "PRODUCT_CODES": extracted_product_codes  # 🎯 Nuevo campo
+        }
+
+
+# ===============================================
+# FUNCIÓN DE EXTRACCIÓN DOCX
+# ===============================================
+
+def extract_docx(docx_file):
+    """
+    Extracción de un DOCX sin llamadas a Streamlit: es la función que ejecutan los
+    procesos del pool (recibe bytes, que se pueden serializar, o un archivo en memoria).
+    El error, si lo hay, se devuelve en "LOAD_ERROR" para que lo muestre quien llama.
+    """
+    # Librería para leer archivos Word (.docx). Quien llama ya verificó que está
+    # instalada (_docx_available en Angela_app.py): aquí no se captura el ImportError.
+    import docx
+
+    extracted_quotation = {**EMPTY_QUOTATION, "LOAD_ERROR": None}
+
+    try:
+        # Load the document from the in-memory uploaded file
+        if isinstance(docx_file, bytes):
+            docx_file = io.BytesIO(docx_file)
+        document = docx.Document(docx_file)
+
+        # 1. Extracción del Número y Fecha de Cotización
+        # Se leen los párrafos hasta el primero que contiene la cotización: el resto del
+        # documento no se lee (paragraph.text recorre el XML de cada párrafo).
+        full_text = []
+        for paragraph in document.paragraphs:
+            paragraph_text = " ".join(paragraph.text.split())
+            if paragraph_text:
+                full_text.append(paragraph_text)
+                if _QUOTE_RE.search(paragraph_text):
+                    break
+        # La búsqueda final es sobre el texto leído unido (como antes con todo el
+        # documento): respeta una cotización repartida entre párrafos anteriores.
+        match = _QUOTE_RE.search(" ".join(full_text))
+
+        if match:
+            quotation_number = match.group(1).strip()
+            quotation_date_raw = match.group(2).strip()
+            formatted_date = quotation_date_raw
+
+            # --- LÓGICA DE LIMPIEZA ---
+            quotation_number = _CB_PREFIX_RE.sub("", quotation_number).strip()
+
+            # Formatear la fecha: se aceptan dd/mm/aaaa, dd-mm-aaaa y dd/mm/aa.
+            # Si no calza o la fecha no existe, se deja la cadena original.
+            date_parts = _DOCX_DATE_RE.fullmatch(quotation_date_raw)
+            if date_parts:
+                day, separator, month, year = date_parts.groups()
+                if len(year) == 4 or (len(year) == 2 and separator == "/"):
+                    # Para validar basta 20aa: los bisiestos de 19aa (aa >= 69) son los mismos
+                    full_year = int(year) if len(year) == 4 else 2000 + int(year)
+                    formatted_date = _format_date(
+                        int(day), int(month), full_year) or quotation_date_raw
+
+            extracted_quotation["QUOTATION_NUMBER"] = quotation_number
+            extracted_quotation["QUOTATION_DATE"] = formatted_date
+
+    except Exception as e:
+        extracted_quotation["LOAD_ERROR"] = str(e)
+
+    return extracted_quotation
+
+
+def extract_pdf(pdf_bytes):
+    """
+    Extracción de un PDF sin caché ni llamadas a Streamlit: es la función que
+    ejecutan los procesos del pool (recibe bytes, que se pueden serializar).
+    """
+    try:
+        extractor = FacturaExtractor(pdf_bytes)
+        result = extractor.extract_all()
+        result["LOAD_ERROR"] = extractor.load_error
+        return result
+    except Exception as e:
+        return {
+            "CLIENT": f"ERROR: No se pudo procesar - {e}",
+            "DATE": "N/A", "NUMBER": "N/A", "DOLLARS": "N/A",
+            "PESOS": "N/A", "EUROS": "N/A", "DESCRIPTION": "N/A",
+            "PRODUCT_CODES": "N/A",  # 🎯 Se añade el nuevo campo al retorno de error
+            "LOAD_ERROR": None
+        }